@@ -50,5 +50,13 @@ create table comments (
 	    `content` mediumtext not null,
 	    `created_at` real not null,
 	    key `idx_created_at` (`created_at`),
+	    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
+	    primary key (`id`)
+) engine=innodb default charset=utf8;
+
+create table blog_html (
+	    `id` varchar(50) not null,
+	    `digest` varchar(50) not null,
+	    `html` mediumtext not null,
 	    primary key (`id`)
 ) engine=innodb default charset=utf8;
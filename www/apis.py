@@ -7,7 +7,7 @@ __author__ = 'XueSong.Ye'
 JSON API definition.
 """
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 
 class Page(object):
@@ -59,6 +59,53 @@ class Page(object):
     __repr__ = __str__
 
 
+class CursorPage(object):
+    """Page object for keyset (cursor) pagination, cost does not grow with page depth."""
+
+    def __init__(self, page_size=10, has_next=False, has_previous=False, next_cursor=None, prev_cursor=None):
+        """Init cursor pagination by page_size and the opaque cursors of neighbour pages.
+
+        >>> p = CursorPage(10, True, False, encode_cursor('next', [1.5, 'a']))
+        >>> p.has_next, p.has_previous, p.limit
+        (True, False, 10)
+        >>> decode_cursor(p.next_cursor)
+        ('next', [1.5, 'a'])
+        """
+        self.page_size = page_size
+        self.limit = page_size
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __str__(self):
+        return 'page_size: %s, has_next: %s, has_previous: %s' % (self.page_size, self.has_next, self.has_previous)
+
+    __repr__ = __str__
+
+
+def encode_cursor(direction, values):
+    """Encode seek direction ('next' or 'prev') and seek values into an opaque url-safe token."""
+    s = json.dumps([direction, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a token made by encode_cursor, raise APIValueError if the token is invalid.
+
+    >>> decode_cursor(encode_cursor('prev', [1.0, 'x']))
+    ('prev', [1.0, 'x'])
+    """
+    try:
+        s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii')).decode('utf-8')
+        direction, values = json.loads(s)
+    except Exception:
+        raise APIValueError('cursor', 'Invalid cursor.')
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return direction, values
+
+
 class APIError(Exception):
     """the base APIError which contains error(required), data(optional) and message(optional)."""
 
@@ -11,19 +11,21 @@ import logging;
 
 logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, os, time, math
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, ChoiceLoader, ModuleLoader
 
 from config import configs
 
-import orm
-from coroweb import add_routes, add_static
+import orm, render, session, coroweb, templating, encoder, compression, launcher
+from coroweb import add_routes, add_static, RequestHandler
 
 from handlers import cookie2user, COOKIE_NAME
 
+WRITE_COOKIE_NAME = 'awesome_write'  # 最后一次写入的时间，见 consistency_factory
+
 
 def init_jinja2(app, **kw):
     """模板引擎初始化"""
@@ -40,12 +42,21 @@ def init_jinja2(app, **kw):
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')  # 获得模板路径
     logging.info('set jinja2 template path: %s' % path)
-    env = Environment(loader=FileSystemLoader(path), **options)  # 用文件系统加载器加载模板
+    loader = FileSystemLoader(path)
+    env = Environment(loader=loader, bytecode_cache=templating.make_bytecode_cache(kw.get('bytecode_cache', None)),
+                      **options)  # 用文件系统加载器加载模板
     filters = kw.get('filters', None)  # 尝试获取过滤器
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    env.globals.update(kw.get('globals', None) or {})  # 模板中可以直接调用的函数，如 static_url()
+    compiled = kw.get('compiled', None)
+    if compiled is not None:  # 预编译为Python模块，编译时需要已注册的过滤器
+        templating.compile_templates(env, path, compiled)
+        env.loader = ChoiceLoader([ModuleLoader(compiled), loader])
     app['__templating__'] = env  # Web实例程序绑定模板属性
+    # 不自动重新加载时启动时一次性解析所有模板，response_factory 直接使用
+    app['__templates__'] = {} if options['auto_reload'] else templating.preload(env, loader.list_templates())
 
 
 async def logger_factory(app, handler):
@@ -59,6 +70,16 @@ async def logger_factory(app, handler):
     return logger
 
 
+async def identity_factory(app, handler):
+    """中间件，为每个请求建立独立的ORM identity map，同一请求内重复的 find() 不再查询数据库"""
+
+    async def identity(request):
+        with orm.identity_scope():
+            return (await handler(request))
+
+    return identity
+
+
 async def auth_factory(app, handler):
     async def auth(request):
         logging.info('check user: %s %s' % (request.method, request.path))
@@ -76,6 +97,63 @@ async def auth_factory(app, handler):
     return auth
 
 
+async def consistency_factory(app, handler):
+    """中间件，让读自己的写对同一客户端的后续请求也生效：请求中有写入时用短期cookie记下写入时间，
+    后续请求带着该cookie时在 read_your_writes 秒内从主库读取"""
+
+    async def consistency(request):
+        orm.restore_last_write(request.cookies.get(WRITE_COOKIE_NAME))
+        before = orm.last_write()
+        r = await handler(request)
+        window = orm.read_your_writes_window()
+        if window and orm.last_write() > before and isinstance(r, web.StreamResponse) and not r.prepared:
+            r.set_cookie(WRITE_COOKIE_NAME, '%.3f' % orm.last_write(), max_age=math.ceil(window), httponly=True)
+        return r
+
+    return consistency
+
+
+async def cache_factory(app, handler):
+    """中间件，按 (method, path, query string, 用户) 缓存 @get(path, cache=ttl) 路由的完整响应并支持ETag/304，
+    @post 处理完成后丢弃其 invalidates 声明的路由的缓存"""
+
+    async def cache(request):
+        route_handler = getattr(request.match_info.handler, '__self__', None)  # add_route 注册的是 RequestHandler.__call__
+        if not isinstance(route_handler, RequestHandler):
+            return (await handler(request))
+        if request.method == 'POST':
+            try:
+                return (await handler(request))
+            finally:
+                coroweb.response_cache.invalidate(route_handler.invalidates)
+        if request.method != 'GET' or not route_handler.cache_ttl:
+            return (await handler(request))
+        user = request.__user__
+        key = (request.method, request.path, request.query_string, None if user is None else user.id)
+        entry = coroweb.response_cache.get(key)
+        if entry is None:
+            r = await handler(request)
+            if type(r) is not web.Response or r.status != 200 or r.cookies or r.body is None \
+                    or 'no-store' in r.headers.get('Cache-Control', ''):
+                return r  # 重定向、错误、设置cookie、流式和声明了no-store的响应不缓存
+            entry = coroweb.response_cache.set(key, route_handler.route, route_handler.cache_ttl, r)
+        return (await entry.respond(request, user is not None, compression.compressor))
+
+    return cache
+
+
+async def compress_factory(app, handler):
+    """中间件，按 Accept-Encoding 用gzip/brotli压缩超过阈值的响应，整页缓存的响应已经在 cache_factory 中压缩"""
+
+    async def compress(request):
+        r = await handler(request)
+        if type(r) is web.Response:  # 跳过重定向等异常响应和已经发出的流式响应
+            r = await compression.compressor.apply(request, r)
+        return r
+
+    return compress
+
+
 async def data_factory(app, handler):
     async def parse_data(request):
         if request.method == 'POST':
@@ -90,6 +168,30 @@ async def data_factory(app, handler):
     return parse_data
 
 
+STREAM_CHUNK_SIZE = 16384  # 流式渲染时攒够多少字符写出一次
+
+
+async def stream_template(request, template, context):
+    """用 Template.generate() 边渲染边写出，页面不必先完整地保存为str和bytes，首字节也更早发出"""
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    await resp.prepare(request)
+    buf = []
+    size = 0
+    for chunk in template.generate(**context):
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            await resp.write(''.join(buf).encode('utf-8'))  # write() 等待缓冲区排空，慢客户端会限制渲染速度
+            buf = []
+            size = 0
+    if buf:
+        await resp.write(''.join(buf).encode('utf-8'))
+    await resp.write_eof()
+    return resp
+
+
 async def response_factory(app, handler):
     async def response(request):
         """对处理函数的响应进行处理"""
@@ -110,15 +212,18 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')  # 处理字典类响应
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda
-                    o: o.__dict__).encode('utf-8'))  # 返回json类响应
+                resp = web.Response(body=encoder.dumps(r))  # 返回json类响应
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode(
-                    'utf-8'))  # 获取模板，并传入响应参数进行渲染，生成HTML
+                t = app['__templates__'].get(template) or app['__templating__'].get_template(template)
+                if r.get('__stream__'):
+                    return (await stream_template(request, t, r))
+                resp = web.Response(body=t.render(**r).encode('utf-8'))  # 获取模板，并传入响应参数进行渲染，生成HTML
                 resp.content_type = 'text/html;charset=utf-8'
+                if r.get('__no_store__'):  # 临时降级的页面，cache_factory 和浏览器都不缓存
+                    resp.headers['Cache-Control'] = 'no-store'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)  # 处理响应码
@@ -148,20 +253,44 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
-async def init(loop):  # 定义init函数，标记为协程，传入loop协程参数
-    """服务器运行程序：创建web实例程序，该实例程序绑定路由和处理函数，运行服务器，监听端口请求，送到路由处理"""
-    await orm.create_pool(loop=loop, **configs.db)
+async def init_app(loop, workers=1):
+    """创建web实例程序，该实例程序绑定路由和处理函数；多进程时每个worker的连接池只占总连接数预算的一份"""
+    await orm.create_pool(loop=loop, **launcher.pool_share(configs.db, workers, configs.server.max_db_connections))
+    orm.init_profiler(**configs.query_profiler)
+    encoder.init_encoder(**configs.json)
+    orm.init_count_cache(**configs.count_cache)
+    render.init_html_cache(**configs.markdown_cache)
+    render.init_renderer(**configs.markdown_render)
+    session.init_session_cache(**configs.session)
+    coroweb.init_response_cache(**configs.response_cache)
+    compression.init_compressor(**configs.compression)
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, identity_factory, auth_factory, consistency_factory, compress_factory, cache_factory,
+        response_factory
     ])  # 创建一个web服务器实例，用于处理URL，HTTP协议
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    static = add_static(app, **configs.static)
+    init_jinja2(app, filters=dict(datetime=datetime_filter), globals=dict(static_url=static.url), **configs.templates)
     add_routes(app, 'handlers')  # 将URL注册进route，将URL和index处理函数绑定，当浏览器敲击URL时，返回处理函数的内容，也就是返回一个HTTP响应
-    add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)  # 创建一个监听服务
-    logging.info('server started at http://127.0.0.1:9000...')
+
+    async def close_pool(app):
+        await orm.close_pool()
+
+    app.on_cleanup.append(close_pool)
+    return app
+
+
+async def init(loop):  # 定义init函数，标记为协程，传入loop协程参数
+    """服务器运行程序：创建web实例程序，运行服务器，监听端口请求，送到路由处理"""
+    app = await init_app(loop)
+    srv = await loop.create_server(app.make_handler(), configs.server.host, configs.server.port)  # 创建一个监听服务
+    logging.info('server started at http://%s:%s...' % (configs.server.host, configs.server.port))
     return srv
 
 
-loop = asyncio.get_event_loop()  # get_event_loop创建一个事件循环，然后使用run_until_complete将协程注册到事件循环，并启动事件循环
-loop.run_until_complete(init(loop))  # run_until_complete()是一个阻塞调用，将协程注册到事件循环，并启动事件循环，直到返回结果
-loop.run_forever()  # run_forever()指一直运行协程，直到调用stop()函数，保证服务器一直开启监听状态
+if __name__ == '__main__':
+    if configs.server.workers > 1:
+        launcher.run(init_app, **configs.server)  # 多进程模式，master监管多个worker
+    else:
+        loop = asyncio.get_event_loop()  # get_event_loop创建一个事件循环，然后使用run_until_complete将协程注册到事件循环，并启动事件循环
+        loop.run_until_complete(init(loop))  # run_until_complete()是一个阻塞调用，将协程注册到事件循环，并启动事件循环，直到返回结果
+        loop.run_forever()  # run_forever()指一直运行协程，直到调用stop()函数，保证服务器一直开启监听状态
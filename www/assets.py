@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+Static asset pipeline: content-hashed URLs, precompressed variants and HTTP caching headers.
+
+启动时扫描 static 目录，按文件内容的sha1生成带指纹的URL，例如 /static/css/uikit.min.3f2a9c1b.css，
+模板中用 {{ static_url('css/uikit.min.css') }} 引用。带指纹的URL内容永远不变，响应 Cache-Control: immutable；
+原始URL仍然可以访问（CSS中的相对路径等），只缓存 max_age 秒并支持 ETag/If-Modified-Since 条件请求。
+
+客户端接受压缩时优先返回同目录下预先压缩的 .br/.gz 文件，没有 .gz 文件时在启动时压缩到内存中；
+解压后与原始文件不一致（修改原始文件后没有重新生成）的压缩文件不使用。每种编码的正文有各自的ETag。
+预先生成压缩文件（需要安装brotli才会生成 .br）：
+
+    $ python3 assets.py
+"""
+
+import os, logging, hashlib, mimetypes, gzip
+
+from email.utils import formatdate
+
+from aiohttp import web
+
+from compression import accepted_encodings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 值得压缩的文件类型，图片和字体（woff本身已压缩）不压缩
+COMPRESSIBLE = ('.css', '.js', '.html', '.svg', '.txt', '.json', '.ttf', '.otf', '.eot')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def _load_variant(path, encoding, digest):
+    """读取预先压缩的文件，解压后与原始文件的sha1比较；压缩文件是构建产物，原始文件修改后没有重新生成时丢弃"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        if encoding == 'br':
+            if brotli is None:  # 无法校验内容，不使用
+                return None
+            body = brotli.decompress(data)
+        else:
+            body = gzip.decompress(data)
+    except Exception as e:
+        logging.warning('ignore broken precompressed file %s: %s' % (path, e))
+        return None
+    if hashlib.sha1(body).hexdigest() != digest:
+        logging.warning('ignore stale precompressed file %s, run assets.py to regenerate it' % path)
+        return None
+    return data
+
+
+class Asset(object):
+    """一个静态文件及其压缩变体：encoding -> bytes，'' 为原始内容"""
+
+    def __init__(self, path, name, compress=True):
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.name = name
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.etag = '"%s"' % self.digest
+        self.last_modified = formatdate(int(os.path.getmtime(path)), usegmt=True)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.variants = {'': body}
+        if os.path.splitext(path)[1].lower() not in COMPRESSIBLE:
+            return
+        for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+            if os.path.isfile(path + ext):
+                data = _load_variant(path + ext, encoding, self.digest)
+                if data is not None:
+                    self.variants[encoding] = data
+        if compress and 'gzip' not in self.variants:
+            self.variants['gzip'] = gzip.compress(body, 9)
+
+    @property
+    def hashed_name(self):
+        root, ext = os.path.splitext(self.name)
+        return '%s.%s%s' % (root, self.digest[:8], ext)
+
+    def etag_for(self, encoding):
+        """每种编码的正文使用不同的ETag，304不会确认另一种编码的内容"""
+        return '"%s-%s"' % (self.digest, encoding) if encoding else self.etag
+
+    def choose(self, accept_encoding):
+        """按客户端的 Accept-Encoding 选择最小的可用变体"""
+        accepted = accepted_encodings(accept_encoding)  # 与动态响应的压缩共用协商逻辑，忽略 q=0 的编码
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and encoding in accepted:
+                return encoding, self.variants[encoding]
+        return None, self.variants['']
+
+
+class StaticAssets(object):
+    """static 目录下所有文件的清单：原始文件名和带指纹的文件名 -> Asset"""
+
+    def __init__(self, path, prefix='/static/', max_age=3600, compress=True):
+        self.path = path
+        self.prefix = prefix
+        self.max_age = max_age
+        self._assets = dict()  # 原始文件名 -> Asset
+        self._hashed = dict()  # 带指纹的文件名 -> Asset
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                if f.endswith(('.gz', '.br')) or f.startswith('.'):
+                    continue
+                full = os.path.join(root, f)
+                name = os.path.relpath(full, path).replace(os.sep, '/')
+                asset = Asset(full, name, compress)
+                self._assets[name] = asset
+                self._hashed[asset.hashed_name] = asset
+        logging.info('static assets: %s files, %s KB' % (
+            len(self._assets), sum(len(a.variants['']) for a in self._assets.values()) // 1024))
+
+    def url(self, name):
+        """模板中使用的 static_url()：返回带指纹的URL，文件不存在时返回原始URL"""
+        asset = self._assets.get(name)
+        if asset is None:
+            return self.prefix + name
+        return self.prefix + asset.hashed_name
+
+    async def handle(self, request):
+        name = request.match_info['path']
+        asset = self._hashed.get(name)
+        if asset is not None:
+            cache_control = IMMUTABLE
+        else:
+            asset = self._assets.get(name)
+            if asset is None:
+                raise web.HTTPNotFound()
+            cache_control = 'public, max-age=%s' % self.max_age
+        encoding, body = asset.choose(request.headers.get('Accept-Encoding'))
+        etag = asset.etag_for(encoding)
+        headers = {'ETag': etag, 'Last-Modified': asset.last_modified, 'Cache-Control': cache_control,
+                   'Vary': 'Accept-Encoding'}
+        inm = request.headers.get('If-None-Match')
+        if (inm is not None and etag in [t.strip() for t in inm.split(',')]) or (
+                inm is None and request.headers.get('If-Modified-Since') == asset.last_modified):
+            return web.Response(status=304, headers=headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        resp = web.Response(body=body, headers=headers)
+        resp.content_type = asset.content_type
+        return resp
+
+
+def precompress(path):
+    """在每个可压缩文件旁生成 .gz（以及安装了brotli时的 .br）文件"""
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            full = os.path.join(root, f)
+            if os.path.splitext(f)[1].lower() not in COMPRESSIBLE:
+                continue
+            with open(full, 'rb') as fp:
+                body = fp.read()
+            with open(full + '.gz', 'wb') as fp:
+                fp.write(gzip.compress(body, 9))
+            if brotli is not None:
+                with open(full + '.br', 'wb') as fp:
+                    fp.write(brotli.compress(body))
+            logging.info('precompressed %s' % full)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    precompress(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+gzip/brotli compression for dynamic responses.
+
+按 Accept-Encoding 协商编码（安装了brotli时优先br），只压缩超过 min_size 字节的文本类响应；
+超过 threaded_size 字节的正文在线程池中压缩（zlib和brotli压缩时释放GIL），不阻塞事件循环。
+整页缓存的响应由 coroweb.CachedResponse 保存压缩后的变体，同一页面只压缩一次。
+"""
+
+import asyncio, gzip, logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+
+
+def accepted_encodings(accept_encoding):
+    """解析 Accept-Encoding，返回可以接受的编码集合，忽略 q=0 的编码
+
+    >>> sorted(accepted_encodings('gzip, deflate, br;q=0'))
+    ['deflate', 'gzip']
+    """
+    accepted = set()
+    for part in (accept_encoding or '').lower().split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+    return accepted
+
+
+class Compressor(object):
+    """响应压缩器"""
+
+    def __init__(self, min_size=1024, threaded_size=65536, level=6, brotli_quality=5, workers=2):
+        self.min_size = min_size
+        self.threaded_size = threaded_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.workers = workers
+        self.compressed = 0
+        self.threaded = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._executor = None
+
+    def compressible(self, content_type, size):
+        return size >= self.min_size and bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def choose(self, accept_encoding, content_type, size):
+        """返回应使用的编码，不需要压缩时返回None"""
+        if not self.compressible(content_type, size):
+            return None
+        accepted = accepted_encodings(accept_encoding)
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def _compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, self.level)
+
+    async def compress(self, body, encoding):
+        if len(body) >= self.threaded_size:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers)
+            self.threaded += 1
+            data = await asyncio.get_event_loop().run_in_executor(self._executor, self._compress, body, encoding)
+        else:
+            data = self._compress(body, encoding)
+        self.compressed += 1
+        self.bytes_in += len(body)
+        self.bytes_out += len(data)
+        return data
+
+    async def apply(self, request, resp):
+        """就地压缩 web.Response 的正文，已经编码过的响应原样返回"""
+        if resp.body is None or 'Content-Encoding' in resp.headers:
+            return resp
+        if not self.compressible(resp.content_type, len(resp.body)):
+            return resp
+        resp.headers['Vary'] = 'Accept-Encoding'
+        encoding = self.choose(request.headers.get('Accept-Encoding'), resp.content_type, len(resp.body))
+        if encoding is not None:
+            resp.body = await self.compress(resp.body, encoding)
+            resp.headers['Content-Encoding'] = encoding
+        return resp
+
+    def stats(self):
+        return dict(compressed=self.compressed, threaded=self.threaded, bytes_in=self.bytes_in,
+                    bytes_out=self.bytes_out)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+compressor = Compressor()
+
+
+def init_compressor(**kw):
+    """按配置创建响应压缩器"""
+    global compressor
+    compressor.shutdown()
+    compressor = Compressor(**kw)
+    logging.info('response compression: min_size=%s, threaded_size=%s, brotli=%s' % (
+        compressor.min_size, compressor.threaded_size, brotli is not None))
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -3,7 +3,11 @@
 
 __author__ = 'XueSong.Ye'
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, hashlib, time
+
+from collections import OrderedDict
+
+from email.utils import formatdate, parsedate_to_datetime
 
 from urllib import parse
 
@@ -11,11 +15,14 @@ from aiohttp import web
 
 from apis import APIError
 
+from assets import StaticAssets
+
 
-def get(path):
+def get(path, cache=None):
     """Define decorator @get('/path')
 
-    @get装饰器，给处理函数绑定URL和HTTP method-GET的属性
+    @get装饰器，给处理函数绑定URL和HTTP method-GET的属性；
+    cache 为整页响应缓存的秒数，None表示不缓存，见 ResponseCache
     """
 
     def decorator(func):
@@ -25,13 +32,17 @@ def get(path):
 
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__cache__ = cache
         return wrapper
 
     return decorator
 
 
-def post(path):
-    """Define decorator @post('/path')"""
+def post(path, invalidates=None):
+    """Define decorator @post('/path')
+
+    invalidates 为处理完成后需要丢弃缓存响应的GET路由（与 @get 的path写法相同），None表示丢弃所有缓存的响应
+    """
 
     def decorator(func):
         @functools.wraps(func)
@@ -40,6 +51,7 @@ def post(path):
 
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__invalidates__ = invalidates
         return wrapper
 
     return decorator
@@ -96,17 +108,81 @@ def has_request_arg(fn):
     return found
 
 
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    v = str(value).lower()
+    if v in ('1', 'true', 'yes', 'on'):
+        return True
+    if v in ('', '0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('Invalid bool: %s' % value)
+
+
+# 参数注解 -> 转换函数，例如 def index(*, page: int = 1)
+_COERCERS = {int: int, float: float, bool: _to_bool, str: str}
+
+
+class BindError(Exception):
+    """请求参数不能绑定到处理函数的参数时抛出，RequestHandler 返回400"""
+    pass
+
+
+def compile_binder(fn):
+    """在注册路由时分析一次处理函数的签名，返回专门的参数绑定函数 bind(params, match_info, request)。
+
+    params 为请求正文或查询字符串解析出的dict（没有时为None），返回调用处理函数的关键字参数dict；
+    参数带有 int/float/bool/str 注解时按注解转换类型，转换失败或缺少必需参数时抛出 BindError。
+    """
+    params = inspect.signature(fn).parameters
+    has_request = has_request_arg(fn)
+    has_var_kw = has_var_kw_arg(fn)
+    named = get_named_kw_args(fn)
+    required = get_required_kw_args(fn)
+    required_set = frozenset(required)
+    keep = named if named and not has_var_kw else None  # 没有 **kw 时只保留命名关键字参数
+    coercers = tuple((name, _COERCERS[p.annotation]) for name, p in params.items()
+                     if name != 'request' and p.annotation in _COERCERS)
+
+    def bind(params, match_info, request):
+        if params is None:
+            kw = dict(match_info)
+        else:
+            if keep is not None:
+                kw = {name: params[name] for name in keep if name in params}
+            else:
+                kw = dict(params)
+            for k, v in match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                kw[k] = v
+        for name, coerce in coercers:
+            if name in kw:
+                try:
+                    kw[name] = coerce(kw[name])
+                except (ValueError, TypeError):
+                    raise BindError('Invalid argument: %s' % name)
+        if has_request:
+            kw['request'] = request
+        if required_set and not required_set.issubset(kw):
+            raise BindError('Missing argument: %s' % [name for name in required if name not in kw][0])
+        return kw
+
+    bind.reads_params = bool(has_var_kw or named)  # 为False时不必解析请求正文和查询字符串
+    return bind
+
+
 class RequestHandler(object):
-    """请求处理器，用来封装处理函数"""
+    """请求处理器，用来封装处理函数，处理函数的签名在构造时编译为参数绑定函数"""
 
     def __init__(self, app, fn):
         self._app = app  # app: an application instance for registering the fn
         self._func = fn  # fn: a request handler with a particular HTTP method and path
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+        self._bind = compile_binder(fn)
+        self._reads_params = self._bind.reads_params
+        self.route = getattr(fn, '__route__', None)
+        self.cache_ttl = getattr(fn, '__cache__', None)
+        self.invalidates = getattr(fn, '__invalidates__', None)
 
     async def __call__(self, request):
         """分析请求
@@ -114,59 +190,31 @@ class RequestHandler(object):
         A request handler can be any callable that accepts a Request instance as its only argument and returns a StreamResponse derived (e.g. Response) instance.
         A handler may also be a coroutine, in which case aiohttp.web will await the handler.
         """
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:  # 当传入的处理函数具有 关键字参数集 或 命名关键字参数 或 request参数
+        params = None
+        if self._reads_params:  # 当传入的处理函数具有 关键字参数集 或 命名关键字参数
             if request.method == 'POST':
                 if not request.content_type:  # 无正文类型信息时返回
-                    return web.HTTPBadRequest('Missing Content-Type.')
+                    return web.HTTPBadRequest(text='Missing Content-Type.')
                 ct = request.content_type.lower()
                 if ct.startswith('application/json'):  # 处理JSON类型的数据，传入参数字典中
                     params = await request.json()
                     if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
+                        return web.HTTPBadRequest(text='JSON body must be object.')
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith(
                         'multipart/form-data'):  # 处理表单类型的数据，传入参数字典中
-                    params = await request.post()
-                    kw = dict(**params)
+                    params = dict(**await request.post())
                 else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
+                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
             if request.method == 'GET':
                 qs = request.query_string
-                if qs:  # 获取URL中的请求参数，如 name=James, id=007
-                    kw = dict()  # 将请求参数传入参数字典中
-                    for k, v in parse.parse_qs(qs, True).items():
-                        """
-                        parse a query string, data are returned as a dict. the dict keys are the unique query variable names and the values are lists of values for each name
-						a True value indicates that blanks should be retained as blank strings
-                        """
-                        kw[k] = v[0]
-        if kw is None:
-            # 请求无请求参数时
-            kw = dict(**request.match_info)
-            # Read-only property with AbstractMatchInfo instance for result of route resolving
-        else:
-            # 参数字典收集请求参数
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:  # 当存在关键字参数未被赋值时返回，例如：一般的账号注册时，没填入密码就提交注册申请时，提示密码未输入
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+                if qs:  # 获取URL中的请求参数，如 name=James, id=007，同名参数只取第一个，保留空值
+                    params = {k: v[0] for k, v in parse.parse_qs(qs, True).items()}
+        try:
+            kw = self._bind(params, request.match_info, request)
+        except BindError as e:
+            return web.HTTPBadRequest(text=str(e))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('call %s with args: %s' % (self._func.__name__, kw))
         try:
             r = await self._func(**kw)  # 最后调用处理函数，并传入请求参数，进行请求处理
             return r
@@ -174,11 +222,136 @@ class RequestHandler(object):
             return dict(error=e.error, data=e.data, message=e.message)
 
 
-def add_static(app):
-    """添加静态资源路径"""
+class CachedResponse(object):
+    """缓存的完整响应，每次命中时据此构造新的 web.Response；压缩后的变体按编码保存，同一页面只压缩一次"""
+
+    __slots__ = ('route', 'expires_at', 'status', 'headers', 'content_type', 'body', 'etag', 'last_modified',
+                 'variants')
+
+    def __init__(self, route, ttl, resp):
+        now = time.time()
+        self.route = route
+        self.expires_at = now + ttl
+        self.status = resp.status
+        self.headers = [(k, v) for k, v in resp.headers.items() if k.lower() != 'content-length']
+        self.content_type = resp.content_type
+        self.body = resp.body
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+        self.last_modified = formatdate(int(now), usegmt=True)
+        self.variants = dict()  # encoding -> 压缩后的正文
+
+    def not_modified(self, request, etag):
+        """按 If-None-Match / If-Modified-Since 判断客户端的副本是否仍然有效"""
+        inm = request.headers.get('If-None-Match')
+        if inm is not None:
+            return inm.strip() == '*' or etag in [t.strip() for t in inm.split(',')]
+        ims = request.headers.get('If-Modified-Since')
+        if ims is not None:
+            try:
+                return parsedate_to_datetime(ims).timestamp() >= parsedate_to_datetime(self.last_modified).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def respond(self, request, private, compressor=None):
+        """构造响应，给出 compression.Compressor 时按 Accept-Encoding 返回压缩的变体"""
+        headers = {'Last-Modified': self.last_modified,
+                   'Cache-Control': 'private, no-cache' if private else 'no-cache'}  # 浏览器每次用ETag重新验证
+        encoding = None
+        if compressor is not None and compressor.compressible(self.content_type, len(self.body)):
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = compressor.choose(request.headers.get('Accept-Encoding'), self.content_type, len(self.body))
+        etag = self.etag if encoding is None else '%s-%s"' % (self.etag[:-1], encoding)  # 每种编码的ETag不同
+        headers['ETag'] = etag
+        if self.not_modified(request, etag):
+            return web.Response(status=304, headers=headers)
+        if encoding is None:
+            body = self.body
+        else:
+            body = self.variants.get(encoding)
+            if body is None:
+                body = self.variants[encoding] = await compressor.compress(self.body, encoding)
+            headers['Content-Encoding'] = encoding
+        resp = web.Response(status=self.status, body=body, headers=self.headers)
+        resp.headers.update(headers)
+        return resp
+
+
+class ResponseCache(object):
+    """整页响应缓存：(method, path, query string, 用户id) -> CachedResponse。
+
+    只缓存 @get(path, cache=ttl) 路由的200响应，条目在 ttl 秒后过期，超出 maxsize 时淘汰最久未使用的条目；
+    @post 处理完成后按其 invalidates 丢弃相关路由的所有条目。缓存在进程内，多进程部署时其他进程的条目最多在 ttl 秒后过期。
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._routes = dict()  # route -> set(key)，用于按路由失效
+
+    def _drop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            keys = self._routes.get(entry.route)
+            if keys is not None:
+                keys.discard(key)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry.expires_at >= time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._drop(key)
+        self.misses += 1
+        return None
+
+    def set(self, key, route, ttl, resp):
+        entry = CachedResponse(route, ttl, resp)
+        if self.maxsize <= 0:
+            return entry
+        self._drop(key)
+        self._data[key] = entry
+        self._routes.setdefault(route, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+        return entry
+
+    def invalidate(self, routes=None):
+        """丢弃指定路由的所有条目，routes为None时全部丢弃"""
+        if routes is None:
+            self._data.clear()
+            self._routes.clear()
+            return
+        for route in routes:
+            for key in list(self._routes.get(route, ())):
+                self._drop(key)
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+
+response_cache = ResponseCache()
+
+
+def init_response_cache(size=1024, **kw):
+    """按配置创建整页响应缓存，size为0时不缓存"""
+    global response_cache
+    response_cache = ResponseCache(size)
+    logging.info('response cache: size=%s' % size)
+
+
+def add_static(app, **kw):
+    """添加静态资源路径，返回 assets.StaticAssets，模板通过其 url() 引用带指纹的URL"""
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')  # 返回脚本所在目录的绝对路径，加上static
-    app.router.add_static('/static/', path)
+    static = StaticAssets(path, '/static/', **kw)
+    app.router.add_route('GET', '/static/{path:.+}', static.handle)
+    app['__static__'] = static
     logging.info('add static %s => %s' % ('/static/', path))
+    return static
 
 
 def add_route(app, fn):
@@ -191,7 +364,8 @@ def add_route(app, fn):
         fn = asyncio.coroutine(fn)
     logging.info(
         'add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    # 注册绑定方法而不是实例：aiohttp会把非协程函数的可调用对象再包装一层，中间件就无法从 match_info.handler 取回 RequestHandler
+    app.router.add_route(method, path, RequestHandler(app, fn).__call__)
 
 
 def add_routes(app, module_name):
@@ -211,3 +385,21 @@ def add_routes(app, module_name):
             path = getattr(fn, '__route__', None)
             if method and path:
                 add_route(app, fn)  # 对已经修饰过的URL处理函数注册到Web服务的路由中
+
+
+if __name__ == '__main__':
+    import timeit
+
+    # 参数绑定的微基准：典型的列表页和带路径参数、必需参数的提交处理函数
+    def api_blogs(*, page: int = 1, cursor=None):
+        pass
+
+    def api_create_comment(id, request, *, content):
+        pass
+
+    for fn, params, match_info in ((api_blogs, dict(page='2', cursor='x', other='y'), dict()),
+                                   (api_create_comment, dict(content='hello'), dict(id='001'))):
+        bind = compile_binder(fn)
+        n = 200000
+        t = timeit.timeit(lambda: bind(params, match_info, None), number=n)
+        print('%s: %.2f us per bind' % (fn.__name__, t / n * 1e6))
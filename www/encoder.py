@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+JSON encoding for API responses.
+
+Model 是dict的子类，由JSON库直接编码；json库不认识的对象按类型查找编码函数：
+紧凑行（Model.__row__）按 __mappings__ 预先生成逐列取值的函数，Page/CursorPage 只输出分页字段，
+其他对象仍然退回到 __dict__。安装了 orjson 时使用 orjson，直接编码为bytes。
+"""
+
+import json, logging, operator
+
+import orm
+
+from apis import Page, CursorPage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoders = dict()  # type -> 把对象转换为可编码对象的函数
+_factories = []  # [(base, make)]，遇到 base 的新子类时调用 make(cls) 生成编码函数
+
+
+def register(cls, encode):
+    """为类型 cls 注册编码函数 encode(obj)，返回值必须可以被JSON库直接编码"""
+    _encoders[cls] = encode
+
+
+def register_factory(base, make):
+    """为 base 的所有子类按需生成编码函数，make(cls) 在第一次遇到该子类时调用一次"""
+    _factories.append((base, make))
+
+
+def fields_encoder(fields):
+    """按固定的属性名生成编码函数"""
+    get = operator.attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda o: {fields[0]: get(o)}
+    return lambda o: dict(zip(fields, get(o)))
+
+
+def row_encoder(cls):
+    """紧凑行的编码函数：所有列都已加载时一次取出全部列，否则只输出已加载的列"""
+    model = cls.__model__
+    fast = fields_encoder([model.__primary_key__] + model.__fields__)
+
+    def encode(row):
+        if row._deferred is orm._NOTHING_DEFERRED:
+            try:
+                return fast(row)
+            except AttributeError:  # 用 fields= 只查询了部分列
+                pass
+        return row.toDict()
+
+    return encode
+
+
+def _lookup(cls):
+    encode = _encoders.get(cls)
+    if encode is None:
+        for base, make in _factories:
+            if issubclass(cls, base):
+                encode = _encoders[cls] = make(cls)
+                break
+    return encode
+
+
+def _default(o):
+    encode = _lookup(type(o))
+    if encode is not None:
+        return encode(o)
+    try:
+        return o.__dict__
+    except AttributeError:
+        raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+register(Page, fields_encoder(
+    ('item_count', 'page_count', 'page_index', 'page_size', 'offset', 'limit', 'has_next', 'has_previous')))
+register(CursorPage, fields_encoder(
+    ('page_size', 'limit', 'has_next', 'has_previous', 'next_cursor', 'prev_cursor')))
+register_factory(orm.CompactRow, row_encoder)
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+
+
+def _json_dumps(obj):
+    return _json_encoder.encode(obj).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_default)
+
+
+_backend = _orjson_dumps if orjson is not None else _json_dumps
+
+
+def dumps(obj):
+    """把API响应编码为UTF-8的bytes
+
+    >>> dumps(dict(page=Page(25, 2), blogs=[]))
+    b'{"page":{"item_count":25,"page_count":3,"page_index":2,"page_size":10,"offset":10,"limit":10,"has_next":true,"has_previous":true},"blogs":[]}'
+    """
+    return _backend(obj)
+
+
+def init_encoder(backend='auto', **kw):
+    """按配置选择JSON库：'auto' 为安装了orjson时使用orjson，'json' 为标准库"""
+    global _backend
+    if backend not in ('auto', 'json', 'orjson'):
+        raise ValueError('Invalid json backend: %s' % backend)
+    if backend == 'orjson' and orjson is None:
+        raise ValueError('orjson is not installed')
+    _backend = _orjson_dumps if backend != 'json' and orjson is not None else _json_dumps
+    logging.info('json encoder: %s' % ('orjson' if _backend is _orjson_dumps else 'json'))
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -5,20 +5,23 @@ __author__ = 'XueSong.Ye'
 
 ' url handlers '
 
-import re, time, json, logging, hashlib, base64, asyncio
-
-import markdown2
+import re, time, logging, hashlib, base64, asyncio
 
 from aiohttp import web
 
 from coroweb import get, post
-from apis import Page, APIValueError, APIResourceNotFoundError
+from apis import Page, CursorPage, APIValueError, APIResourceNotFoundError, encode_cursor, decode_cursor
 
 from models import User, Comment, Blog, next_id
+from render import render_blog, invalidate_blog, text2html
+from metrics import format_metrics
+import orm, session, schema, encoder
 from config import configs
 
 COOKIE_NAME = 'yxssession'
 _COOKIE_KEY = configs.session.secret
+BLOG_ROUTES = ('/', '/blog/{id}', '/api/blogs')  # 日志增删改后需要丢弃缓存响应的路由
+STREAM_COMMENTS = 200  # 评论数超过该值时日志页面流式渲染
 
 
 def check_admin(request):
@@ -37,6 +40,35 @@ def get_page_index(page_str):
     return p
 
 
+async def find_cursor_page(model, cursor=None, where=None, args=None, page_size=10, **kw):
+    """Keyset pagination: locate page by cursor instead of OFFSET, return (CursorPage, items)."""
+    direction, values = decode_cursor(cursor) if cursor else ('next', None)
+    if values is not None and (len(values) != len(model.__seek_keys__) or not all(
+            isinstance(v, (str, int, float)) and not isinstance(v, bool) for v in values)):
+        raise APIValueError('cursor', 'Invalid cursor.')  # 被篡改或属于其他模型的游标
+    if values is None:
+        seek = dict(seek=True)
+    elif direction == 'next':
+        seek = dict(after=values)
+    else:
+        seek = dict(before=values)
+    # 多取一条，用来判断前进方向上是否还有数据
+    items = await model.findAll(where, args, limit=page_size + 1, **dict(kw, **seek))
+    more = len(items) > page_size
+    if direction == 'next':
+        items = items[:page_size]
+        has_next, has_previous = more, values is not None
+    else:
+        items = items[-page_size:]
+        has_next, has_previous = True, more
+    p = CursorPage(page_size, has_next and len(items) > 0, has_previous and len(items) > 0)
+    if p.has_next:
+        p.next_cursor = encode_cursor('next', items[-1].getSeekValues())
+    if p.has_previous:
+        p.prev_cursor = encode_cursor('prev', items[0].getSeekValues())
+    return p, items
+
+
 def user2cookie(user, max_age):
     """Generate cookie str by user."""
     # build cookie string by: id-expires-sha1
@@ -46,12 +78,6 @@ def user2cookie(user, max_age):
     return '-'.join(L)
 
 
-def text2html(text):
-    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'),
-                filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
-
-
 async def cookie2user(cookie_str):
     """Parse cookie and load user if cookie is valid."""
     if not cookie_str:
@@ -63,6 +89,9 @@ async def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
+        cached = await session.session_cache.get(cookie_str)
+        if cached is not None:
+            return User(**cached)
         user = await User.find(uid)
         if user is None:
             return None
@@ -70,22 +99,31 @@ async def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        user = User(**user)  # identity map中的实例保留原始数据，只对副本隐藏口令
         user.passwd = '******'
+        await session.session_cache.set(cookie_str, uid, expires, user)
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
 
-@get('/')
-async def index(*, page='1'):
+@get('/', cache=30)
+async def index(*, page='1', cursor=None):
+    if cursor is not None:
+        page, blogs = await find_cursor_page(Blog, cursor, defer=True, compact=True)
+        return {
+            '__template__': 'blogs.html',
+            'page': page,
+            'blogs': blogs
+        }
     page_index = get_page_index(page)
-    num = await  Blog.findNumber('count(id)')
+    num = await Blog.findCount()
     page = Page(num)
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit), defer=True, compact=True)
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -93,15 +131,17 @@ async def index(*, page='1'):
     }
 
 
-@get('/blog/{id}')
+@get('/blog/{id}', cache=60)
 async def get_blog(id):
     blog = await Blog.find(id)
     comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    blog.html_content, complete = await render_blog(blog)
     return {
         '__template__': 'blog.html',
+        '__stream__': len(comments) > STREAM_COMMENTS,  # 评论很多的页面流式输出，不进入响应缓存
+        '__no_store__': not complete,  # 渲染超时退回纯文本的页面不缓存，稍后转换完成时再正常显示
         'blog': blog,
         'comments': comments
     }
@@ -121,7 +161,7 @@ def signin():
     }
 
 
-@post('/api/authenticate')
+@post('/api/authenticate', invalidates=())
 async def authenticate(*, email, passwd):
     if not email:
         raise APIValueError('email', 'Invalid email.')
@@ -143,13 +183,16 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
 
 @get('/signout')
-def signout(request):
+async def signout(request):
     referer = request.headers.get('Referer')
+    cookie_str = request.cookies.get(COOKIE_NAME)
+    if cookie_str:
+        await session.session_cache.delete(cookie_str)
     r = web.HTTPFound(referer or '/')
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
     logging.info('user signed out.')
@@ -162,18 +205,18 @@ def manage():
 
 
 @get('/manage/comments')
-def manage_comments(*, page='1'):
+def manage_comments(*, cursor=''):
     return {
         '__template__': 'manage_comments.html',
-        'page_index': get_page_index(page)
+        'cursor': cursor
     }
 
 
 @get('/manage/blogs')
-def manage_blogs(*, page='1'):
+def manage_blogs(*, cursor=''):
     return {
         '__template__': 'manage_blogs.html',
-        'page_index': get_page_index(page)
+        'cursor': cursor
     }
 
 
@@ -196,25 +239,28 @@ def manage_edit_blog(*, id):
 
 
 @get('/manage/users')
-def manage_users(*, page='1'):
+def manage_users(*, cursor=''):
     return {
         '__template__': 'manage_users.html',
-        'page_index': get_page_index(page)
+        'cursor': cursor
     }
 
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        p, comments = await find_cursor_page(Comment, cursor, compact=True)
+        return dict(page=p, comments=comments)
     page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
+    num = await Comment.findCount(estimate=configs.count_cache.estimate)
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
     return dict(page=p, comments=comments)
 
 
-@post('/api/blogs/{id}/comments')
+@post('/api/blogs/{id}/comments', invalidates=('/blog/{id}',))
 async def api_create_comment(id, request, *, content):
     user = request.__user__
     if user is None:
@@ -230,7 +276,7 @@ async def api_create_comment(id, request, *, content):
     return comment
 
 
-@post('/api/comments/{id}/delete')
+@post('/api/comments/{id}/delete', invalidates=('/blog/{id}',))
 async def api_delete_comments(id, request):
     check_admin(request)
     c = await Comment.find(id)
@@ -241,13 +287,18 @@ async def api_delete_comments(id, request):
 
 
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', cursor=None):
+    if cursor is not None:
+        p, users = await find_cursor_page(User, cursor, compact=True)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
+    num = await User.findCount(estimate=configs.count_cache.estimate)
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
@@ -257,7 +308,7 @@ _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$'
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
 
-@post('/api/users')
+@post('/api/users', invalidates=())
 async def api_register_user(*, email, name, passwd):
     if not name or not name.strip():
         raise APIValueError('name')
@@ -278,18 +329,21 @@ async def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
 
-@get('/api/blogs')
-async def api_blogs(*, page='1'):
+@get('/api/blogs', cache=30)
+async def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p, blogs = await find_cursor_page(Blog, cursor, defer=True, compact=True)
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await Blog.findCount()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), defer=True, compact=True)
     return dict(page=p, blogs=blogs)
 
 
@@ -299,7 +353,7 @@ async def api_get_blog(*, id):
     return blog
 
 
-@post('/api/blogs')
+@post('/api/blogs', invalidates=BLOG_ROUTES)
 async def api_create_blog(request, *, name, summary, content):
     check_admin(request)
     if not name or not name.strip():
@@ -314,7 +368,7 @@ async def api_create_blog(request, *, name, summary, content):
     return blog
 
 
-@post('/api/blogs/{id}')
+@post('/api/blogs/{id}', invalidates=BLOG_ROUTES)
 async def api_update_blog(id, request, *, name, summary, content):
     check_admin(request)
     blog = await Blog.find(id)
@@ -328,12 +382,60 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.summary = summary.strip()
     blog.content = content.strip()
     await blog.update()
+    await invalidate_blog(blog.id)
     return blog
 
 
-@post('/api/blogs/{id}/delete')
+@post('/api/blogs/{id}/delete', invalidates=BLOG_ROUTES)
 async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
-    await blog.remove()
+    async with orm.transaction():  # 日志和它的评论一起删除
+        await blog.remove()
+        await Comment.deleteWhere('`blog_id`=?', [id])
+    await invalidate_blog(id)
     return dict(id=id)
+
+
+@get('/metrics')
+def metrics(request):
+    """Prometheus格式的连接池和查询耗时指标，只允许 configs.metrics.allow 中的地址访问"""
+    if request.remote not in configs.metrics.allow:
+        return web.HTTPForbidden()
+    stats = orm.pool_stats()
+    pools = stats['pools']
+    gauges = [('size', 'Open connections.'), ('freesize', 'Idle connections.'), ('maxsize', 'Pool size limit.'),
+              ('in_use', 'Connections in use.'), ('acquired', 'Connections acquired.'),
+              ('timeouts', 'Connection acquire timeouts.')]
+    L = [('db_pool_%s' % k, 'counter' if k in ('acquired', 'timeouts') else 'gauge', h,
+          [(dict(pool=p['name']), p[k]) for p in pools]) for k, h in gauges]
+    L.append(('db_pool_wait_seconds', 'histogram', 'Time spent waiting for a pooled connection.',
+              [(dict(pool=p['name']), p['wait']) for p in pools]))
+    L.append(('db_replica_lag_seconds', 'gauge', 'Replication lag of read replicas.',
+              [(dict(pool=p['name']), p['lag']) for p in pools if 'lag' in p and p['lag'] is not None]))
+    L.append(('db_replica_healthy', 'gauge', 'Whether the read replica is in rotation.',
+              [(dict(pool=p['name']), int(p['healthy'])) for p in pools if 'healthy' in p]))
+    L.append(('db_query_seconds', 'histogram', 'Query time per SQL shape.',
+              [(dict(sql=sql), h) for sql, h in stats['queries'].items()]))
+    caches = orm.sql_cache_stats()
+    for k, t, h in (('hits', 'counter', 'SQL string cache hits.'), ('misses', 'counter', 'SQL string cache misses.'),
+                    ('size', 'gauge', 'Cached SQL strings.')):
+        L.append(('sql_cache_%s' % k, t, h, [(dict(cache=c), caches[c][k]) for c in ('driver', 'shape')]))
+    r = web.Response(body=format_metrics(L).encode('utf-8'))
+    r.content_type = 'text/plain'
+    r.charset = 'utf-8'
+    return r
+
+
+@get('/api/schema/advice')
+async def api_schema_advice(request):
+    """对运行以来记录的查询执行EXPLAIN，返回全表扫描等问题和建议的索引，仅管理员可用"""
+    check_admin(request)
+    return dict(advice=await schema.advise())
+
+
+@get('/api/profile/queries')
+def api_profile_queries(request):
+    """按查询形状统计的次数、耗时分位数和返回行数，仅管理员可用"""
+    check_admin(request)
+    return dict(slow=orm.profiler.slow, sample_rate=orm.profiler.sample_rate, queries=orm.profiler.stats())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+Multi-process launcher: a master that forks workers sharing one listening port.
+
+每个worker是独立的进程，有自己的事件循环和连接池，多个worker共同监听同一个端口：
+支持SO_REUSEPORT时每个worker各自绑定端口，由内核分配连接；否则由master预先绑定，worker继承该socket。
+
+master 负责：
+* worker异常退出时重新启动（连续快速崩溃时逐渐延长等待时间）；
+* SIGTERM/SIGINT：通知所有worker停止接受新连接，处理完已有请求后退出，超过 shutdown_timeout 秒的强制结束；
+* SIGHUP：平滑重启，master重新执行自身（加载新代码和配置），新一批worker就绪后再让旧的worker退出，期间端口一直可用。
+
+只能在提供 os.fork() 的系统上使用多进程模式。各worker的进程内缓存互不共享，失效只发生在处理写请求的worker中，
+其他worker要等缓存过期才能看到修改（见 config_default.py 中 server.workers 的说明）。
+"""
+
+import asyncio, os, sys, signal, socket, time, select, logging
+
+# 平滑重启时通过环境变量传给新master的信息
+ENV_FD = 'AWESOME_LISTEN_FD'
+ENV_OLD_WORKERS = 'AWESOME_OLD_WORKERS'
+
+
+def pool_share(db, workers, max_connections=None):
+    """按总连接数预算计算每个worker的连接池参数：maxsize 和 max_maxsize 不超过 max_connections // workers。
+
+    预算针对每个数据库服务器，副本的连接池使用相同的大小。max_connections 为None时原样返回。
+    SIGHUP平滑重启时新旧两批worker会短暂并存，连接数最多可达预算的两倍，数据库的 max_connections 要留出余量。
+    """
+    kw = dict(db)
+    if not max_connections:
+        return kw
+    share = max(1, max_connections // workers)
+    kw['maxsize'] = min(kw.get('maxsize', 10), share)
+    kw['minsize'] = min(kw.get('minsize', 1), kw['maxsize'])
+    kw['max_maxsize'] = min(kw.get('max_maxsize', None) or share, share)
+    return kw
+
+
+def bind_socket(host, port):
+    """master预先绑定的监听socket，fork后由所有worker共用"""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(make_app, sock, host, port, workers, shutdown_timeout, ready_fd=None):
+    """worker进程的主体：建立应用并开始服务，收到SIGTERM/SIGINT后平滑退出"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = loop.run_until_complete(make_app(loop, workers))
+    handler = app.make_handler()
+    if sock is None:
+        srv = loop.run_until_complete(loop.create_server(handler, host, port, reuse_port=True))
+    else:
+        srv = loop.run_until_complete(loop.create_server(handler, sock=sock))
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, loop.stop)
+    if ready_fd is not None:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+    logging.info('worker %s serving on http://%s:%s...' % (os.getpid(), host, port))
+    loop.run_forever()
+    logging.info('worker %s shutting down...' % os.getpid())
+    srv.close()  # 不再接受新连接
+    loop.run_until_complete(app.shutdown())
+    loop.run_until_complete(handler.shutdown(shutdown_timeout))  # 等待进行中的请求完成
+    loop.run_until_complete(app.cleanup())
+    loop.close()
+
+
+class Master(object):
+    """fork并监管worker进程"""
+
+    def __init__(self, make_app, host='127.0.0.1', port=9000, workers=2, reuse_port=True, shutdown_timeout=10,
+                 **kw):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('multi-process mode requires os.fork()')
+        self.make_app = make_app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.shutdown_timeout = shutdown_timeout
+        self.sock = None
+        self._children = dict()  # pid -> 启动时间
+        self._old = set()  # 平滑重启前的worker，退出后不再重启
+        self._crashes = 0
+        self._respawns = 0  # 等待重新启动的worker数
+        self._respawn_at = 0  # 连续快速崩溃时，在这个时间之前不重新启动
+        self._signal = None
+
+    def _spawn(self, ready_fd=None):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_DFL)
+                run_worker(self.make_app, self.sock, self.host, self.port, self.workers, self.shutdown_timeout,
+                           ready_fd)
+            except BaseException as e:
+                logging.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        self._children[pid] = time.time()
+        return pid
+
+    def _spawn_all(self):
+        """启动一批worker，等待它们都开始监听（最多 shutdown_timeout 秒）"""
+        r, w = os.pipe()
+        for _ in range(self.workers):
+            self._spawn(w)
+        os.close(w)
+        ready = 0
+        deadline = time.time() + max(self.shutdown_timeout, 30)
+        while ready < self.workers and time.time() < deadline:
+            if select.select([r], [], [], 0.5)[0]:
+                data = os.read(r, self.workers)
+                if not data:
+                    break  # 所有worker都已写入或退出
+                ready += len(data)
+        os.close(r)
+        logging.info('%s/%s workers ready' % (ready, self.workers))
+
+    def _on_signal(self, sig, frame):
+        self._signal = sig
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self._children.pop(pid, None)
+            if pid in self._old:
+                self._old.discard(pid)
+                continue
+            if started is None or self._signal in (signal.SIGTERM, signal.SIGINT):
+                continue
+            code = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+            logging.error('worker %s exited unexpectedly with %s' % (pid, code))
+            self._crashes = self._crashes + 1 if time.time() - started < 5 else 0
+            if self._crashes:  # 连续快速崩溃时延长等待，避免反复fork；由主循环到时再启动，期间照常响应信号
+                self._respawn_at = max(self._respawn_at, time.time() + min(30, 2 ** self._crashes))
+            self._respawns += 1
+
+    def _respawn(self):
+        if self._respawns and time.time() >= self._respawn_at:
+            for _ in range(self._respawns):
+                self._spawn()
+            self._respawns = 0
+
+    def _stop(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _wait_all(self):
+        deadline = time.time() + self.shutdown_timeout
+        while (self._children or self._old) and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self._children) + list(self._old):
+            try:
+                os.kill(pid, signal.SIGKILL)
+                logging.warning('worker %s killed after %ss' % (pid, self.shutdown_timeout))
+            except ProcessLookupError:
+                pass
+
+    def _reload(self):
+        """重新执行master自身，监听的socket和当前worker的pid通过环境变量传给新的master"""
+        logging.info('reloading master %s...' % os.getpid())
+        env = dict(os.environ)
+        env[ENV_OLD_WORKERS] = ','.join(str(pid) for pid in list(self._children) + list(self._old))
+        if self.sock is not None:
+            self.sock.set_inheritable(True)
+            env[ENV_FD] = str(self.sock.fileno())
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+    def run(self):
+        fd = os.environ.pop(ENV_FD, None)
+        old = os.environ.pop(ENV_OLD_WORKERS, '')
+        self._old = set(int(pid) for pid in old.split(',') if pid)
+        if fd is not None:
+            self.sock = socket.socket(fileno=int(fd))
+        elif not self.reuse_port:
+            self.sock = bind_socket(self.host, self.port)
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self._on_signal)
+        logging.info('master %s starting %s workers on http://%s:%s (%s)...' % (
+            os.getpid(), self.workers, self.host, self.port, 'SO_REUSEPORT' if self.sock is None else 'shared socket'))
+        self._spawn_all()
+        if self._old:
+            self._stop(self._old)  # 新的worker已经在监听，旧的worker处理完已有请求后退出
+        while True:
+            sig, self._signal = self._signal, None
+            if sig in (signal.SIGTERM, signal.SIGINT):
+                self._signal = sig
+                logging.info('master %s stopping...' % os.getpid())
+                self._stop(list(self._children) + list(self._old))
+                self._wait_all()
+                return
+            if sig == signal.SIGHUP:
+                self._reload()
+            self._reap()
+            self._respawn()
+            time.sleep(0.2)
+
+
+def run(make_app, **kw):
+    """以多进程模式运行，make_app(loop, workers) 为创建 web.Application 的协程函数"""
+    Master(make_app, **kw).run()
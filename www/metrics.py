@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+Histogram and Prometheus text format helpers for the /metrics endpoint.
+"""
+
+import bisect
+
+# 默认分桶上限（秒），与Prometheus客户端的默认值一致
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """累积分桶直方图，只记录每个桶的计数、总数和总和，观测一次的开销是一次二分查找"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """按桶内线性插值估算分位数，落在 +Inf 桶时返回最大的有限上限
+
+        >>> h = Histogram((0.1, 0.2, 0.4))
+        >>> for v in (0.05, 0.15, 0.15, 0.3):
+        ...     h.observe(v)
+        >>> h.quantile(0.5), h.quantile(0.99)
+        (0.15, 0.392)
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            if c and n + c >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return round(lower + (self.buckets[i] - lower) * (rank - n) / c, 6)
+            n += c
+        return self.buckets[-1]
+
+    def stats(self):
+        cumulative = []
+        n = 0
+        for le, c in zip(self.buckets + (float('inf'),), self.counts):
+            n += c
+            cumulative.append((le, n))
+        return dict(count=self.count, sum=self.sum, buckets=cumulative)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in sorted(labels.items()))
+
+
+def format_metrics(metrics):
+    """把 [(name, type, help, [(labels, value), ...]), ...] 格式化为Prometheus文本格式。
+
+    type 为 'histogram' 时，value 为 Histogram.stats() 的返回值。
+
+    >>> h = Histogram((0.1, 1))
+    >>> h.observe(0.05)
+    >>> print(format_metrics([('wait_seconds', 'histogram', 'Wait.', [(dict(pool='primary'), h.stats())])]))
+    # HELP wait_seconds Wait.
+    # TYPE wait_seconds histogram
+    wait_seconds_bucket{le="0.1",pool="primary"} 1
+    wait_seconds_bucket{le="1",pool="primary"} 1
+    wait_seconds_bucket{le="+Inf",pool="primary"} 1
+    wait_seconds_sum{pool="primary"} 0.05
+    wait_seconds_count{pool="primary"} 1
+    <BLANKLINE>
+    """
+    L = []
+    for name, mtype, help, samples in metrics:
+        L.append('# HELP %s %s' % (name, help))
+        L.append('# TYPE %s %s' % (name, mtype))
+        for labels, value in samples:
+            if mtype == 'histogram':
+                for le, n in value['buckets']:
+                    bucket = dict(labels, le='+Inf' if le == float('inf') else '%g' % le)
+                    L.append('%s_bucket%s %s' % (name, _labels(bucket), n))
+                L.append('%s_sum%s %s' % (name, _labels(labels), value['sum']))
+                L.append('%s_count%s %s' % (name, _labels(labels), value['count']))
+            else:
+                L.append('%s%s %s' % (name, _labels(labels), value))
+    L.append('')
+    return '\n'.join(L)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -9,6 +9,8 @@ __author__ = 'yexuesong'
 
 import time, uuid
 
+import orm, session
+
 from orm import Model, StringField, BooleanField, FloatField, TextField
 
 
@@ -19,6 +21,8 @@ def next_id():
 class User(Model):
     """User类映射MySQL数据库中的User表"""
     __table__ = 'users'  # 表名
+    __indexes__ = [('created_at',)]
+    __unique_indexes__ = [('email',)]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')  # 主键
     email = StringField(ddl='varchar(50)')  # 作为登录账号
@@ -28,10 +32,46 @@ class User(Model):
     image = StringField(ddl='varchar(500)')  # 列
     created_at = FloatField(default=time.time)  # 列
 
+    async def update(self):
+        """口令或管理员标志可能变化，更新后丢弃该用户已缓存的会话"""
+        await super(User, self).update()
+        await session.session_cache.invalidate_user(self.id)
+
+    async def remove(self):
+        await super(User, self).remove()
+        await session.session_cache.invalidate_user(self.id)
+
+    @classmethod
+    async def updateMany(cls, objs, chunk_size=500):
+        objs = list(objs)
+        rows = await super(User, cls).updateMany(objs, chunk_size)
+        for u in objs:
+            await session.session_cache.invalidate_user(u.id)
+        return rows
+
+    @classmethod
+    async def deleteMany(cls, pks, chunk_size=500):
+        pks = list(pks)
+        rows = await super(User, cls).deleteMany(pks, chunk_size)
+        for uid in pks:
+            await session.session_cache.invalidate_user(uid)
+        return rows
+
+    @classmethod
+    async def deleteWhere(cls, where, args=None, chunk_size=None):
+        """按条件删除前先在主库上查出匹配的用户id，删除后丢弃这些用户已缓存的会话"""
+        rs = await orm.select('select `%s` from `%s` where %s' % (cls.__primary_key__, cls.__table__, where), args,
+                              primary=True) if where else []
+        rows = await super(User, cls).deleteWhere(where, args, chunk_size)
+        for r in rs:
+            await session.session_cache.invalidate_user(r[cls.__primary_key__])
+        return rows
+
 
 class Blog(Model):
     """Blog类映射MySQL数据库中的blogs表"""
     __table__ = 'blogs'
+    __indexes__ = [('created_at',)]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -39,18 +79,28 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
     created_at = FloatField(default=time.time)
 
 
 class Comment(Model):
     """Comment类映射MySQL数据库中的comments表"""
     __table__ = 'comments'
+    __indexes__ = [('created_at',), ('blog_id', 'created_at')]  # get_blog 按 blog_id 过滤、按 created_at 排序
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
     created_at = FloatField(default=time.time)
+
+
+class BlogHtml(Model):
+    """BlogHtml类映射MySQL数据库中的blog_html表，持久化缓存日志正文渲染后的HTML"""
+    __table__ = 'blog_html'
+
+    id = StringField(primary_key=True, ddl='varchar(50)')  # 对应blogs表的id
+    digest = StringField(ddl='varchar(50)')  # 渲染时正文的sha1
+    html = TextField(ddl='mediumtext')
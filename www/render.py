@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+Markdown rendering with a cache keyed by blog id and content digest.
+
+日志正文很少修改，但每次浏览都要完整执行一遍 markdown2 的正则转换。
+这里按 blog id 缓存渲染结果，并记录渲染时正文的sha1，正文变化后缓存自动失效；
+内存中按LRU淘汰，可选地持久化到 blog_html 表，进程重启后不必重新渲染。
+
+markdown2.markdown() 每次调用都会构造新的 Markdown 实例（重新编译正则、复制转义表），
+这里按参数组合维护可复用的实例池，协程和线程池中的线程都可以安全地共用。
+
+Markdown 转换是纯CPU运算，大篇幅的日志在事件循环中转换会阻塞所有其他请求，
+超过长度阈值的正文交给进程池或线程池转换，并限制排队数量和等待时间，超时则退回为转义后的纯文本。
+"""
+
+import asyncio, logging, hashlib, threading, time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from collections import OrderedDict
+
+import markdown2
+
+import orm
+
+from models import BlogHtml
+
+
+class LRUCache(object):
+    """有容量上限的LRU缓存，超出 maxsize 时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value  # 重新插入到末尾，标记为最近使用
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ConverterPool(object):
+    """同一组参数的 Markdown 实例池。
+
+    Markdown.convert() 开始时会调用 reset() 清空上次转换的状态，所以实例可以复用，
+    但转换过程中实例不能被其他线程使用：每次转换从池中取出一个空闲实例，用完放回，没有空闲实例时新建。
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self._free = []
+        self._stats = dict()  # id(instance) -> 该实例的转换统计
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        md = markdown2.Markdown(**self.options)
+        with self._lock:
+            self._stats[id(md)] = dict(conversions=0, chars=0, seconds=0.0)
+        return md
+
+    def _release(self, md):
+        with self._lock:
+            self._free.append(md)
+
+    def convert(self, text):
+        md = self._acquire()
+        try:
+            start = time.perf_counter()
+            html = md.convert(text)
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats[id(md)]
+                stats['conversions'] += 1
+                stats['chars'] += len(text)
+                stats['seconds'] += elapsed
+            return html
+        finally:
+            self._release(md)
+
+    def stats(self):
+        """返回每个实例的转换次数、字符数和耗时"""
+        with self._lock:
+            return [dict(s) for s in self._stats.values()]
+
+
+_converters = dict()
+_converters_lock = threading.Lock()
+
+
+def _converter_key(html4tags, tab_width, safe_mode, extras):
+    if safe_mode is True:
+        safe_mode = 'replace'
+    if isinstance(extras, dict):
+        extras = tuple(sorted((k, repr(v)) for k, v in extras.items()))
+    else:
+        extras = tuple(sorted((e, repr(None)) for e in (extras or ())))
+    return html4tags, tab_width, safe_mode, extras
+
+
+def get_converter(html4tags=False, tab_width=markdown2.DEFAULT_TAB_WIDTH, safe_mode=None, extras=None):
+    """按参数组合返回预先配置好的 ConverterPool，同一组参数始终返回同一个池"""
+    key = _converter_key(html4tags, tab_width, safe_mode, extras)
+    pool = _converters.get(key)
+    if pool is None:
+        with _converters_lock:
+            pool = _converters.get(key)
+            if pool is None:
+                pool = ConverterPool(html4tags=html4tags, tab_width=tab_width, safe_mode=safe_mode, extras=extras)
+                _converters[key] = pool
+    return pool
+
+
+def markdown(text, **options):
+    """与 markdown2.markdown() 相同，但复用实例池中的 Markdown 实例"""
+    return get_converter(**options).convert(text)
+
+
+def converter_stats():
+    """返回所有实例池的统计信息，用于监控"""
+    with _converters_lock:
+        pools = list(_converters.items())
+    return [dict(options=dict(zip(('html4tags', 'tab_width', 'safe_mode', 'extras'), key)), instances=pool.stats())
+            for key, pool in pools]
+
+
+def text2html(text):
+    """将纯文本按行转义为HTML段落"""
+    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'),
+                filter(lambda s: s.strip() != '', text.split('\n')))
+    return ''.join(lines)
+
+
+def _convert(text, options):
+    """在执行器中运行的转换函数，必须定义在模块级别，以便进程池可以pickle"""
+    return markdown(text, **options)
+
+
+class Renderer(object):
+    """异步Markdown渲染。
+
+    长度小于 threshold 的正文直接在事件循环中转换；更长的正文交给执行器（'process' 或 'thread'），
+    同时在执行器中排队或运行的转换最多 max_pending 个，超出时协程等待（背压）；
+    等待加转换超过 timeout 秒时抛出 asyncio.TimeoutError，已提交的转换会继续执行，完成后回调 callback。
+    """
+
+    def __init__(self, threshold=32768, executor='process', workers=2, max_pending=8, timeout=2.0):
+        if executor not in ('process', 'thread'):
+            raise ValueError('Invalid executor: %s' % executor)
+        self.threshold = threshold
+        self.executor = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.offloaded = 0
+        self.timeouts = 0
+        self._executor = None
+        self._semaphore = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor == 'process':
+                self._executor = ProcessPoolExecutor(self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    async def _offload(self, text, options, submitted):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        await self._semaphore.acquire()
+        try:
+            fut = asyncio.wrap_future(self._get_executor().submit(_convert, text, options))
+        except BaseException:
+            self._semaphore.release()
+            raise
+        self.offloaded += 1
+        fut.add_done_callback(lambda f: self._semaphore.release())  # 转换真正结束后才释放名额
+        submitted.append(fut)
+        return await asyncio.shield(fut)  # 超时只取消等待，不取消已提交的转换
+
+    async def convert(self, text, callback=None, **options):
+        if len(text) < self.threshold:
+            return markdown(text, **options)
+        submitted = []
+        try:
+            return await asyncio.wait_for(self._offload(text, options, submitted), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if callback is not None and submitted:  # 只有超时的转换才回调，正常返回的结果由调用者处理
+                def done(f):
+                    if not f.cancelled() and f.exception() is None:
+                        callback(f.result())
+
+                submitted[0].add_done_callback(done)
+            raise
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+renderer = Renderer()
+
+
+def init_renderer(**kw):
+    """按配置创建异步渲染器"""
+    global renderer
+    renderer.shutdown()
+    renderer = Renderer(**kw)
+    logging.info('markdown renderer: threshold=%s, executor=%s, workers=%s, max_pending=%s, timeout=%ss' % (
+        renderer.threshold, renderer.executor, renderer.workers, renderer.max_pending, renderer.timeout))
+
+
+def content_digest(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# 一条语句完成插入或覆盖，并发渲染同一篇日志时不会出现先查后插的主键冲突
+_UPSERT_HTML = 'insert into `%s` (`id`, `digest`, `html`) values (?, ?, ?) ' \
+               'on duplicate key update `digest`=values(`digest`), `html`=values(`html`)' % BlogHtml.__table__
+
+
+class HtmlCache(object):
+    """日志正文HTML缓存：blog id -> (digest, html)"""
+
+    def __init__(self, maxsize=256, persistent=False):
+        self.persistent = persistent
+        self._lru = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, blog_id, digest):
+        entry = self._lru.get(blog_id)
+        if entry is not None and entry[0] == digest:
+            self.hits += 1
+            return entry[1]
+        if self.persistent:
+            row = await BlogHtml.find(blog_id)
+            if row is not None and row.digest == digest:
+                self.hits += 1
+                self._lru.set(blog_id, (digest, row.html))
+                return row.html
+        self.misses += 1
+        return None
+
+    async def set(self, blog_id, digest, html):
+        self._lru.set(blog_id, (digest, html))
+        if self.persistent:
+            await orm.execute(_UPSERT_HTML, [blog_id, digest, html])
+
+    async def invalidate(self, blog_id):
+        self._lru.pop(blog_id)
+        if self.persistent:
+            row = await BlogHtml.find(blog_id)
+            if row is not None:
+                await row.remove()
+
+
+html_cache = HtmlCache()
+
+
+def init_html_cache(size=256, persistent=False, **kw):
+    """按配置创建日志正文HTML缓存"""
+    global html_cache
+    html_cache = HtmlCache(size, persistent)
+    logging.info('markdown html cache: size=%s, persistent=%s' % (size, persistent))
+
+
+async def render_blog(blog):
+    """返回 (html, complete)：日志正文渲染后的HTML，正文未变化时直接使用缓存；
+    转换超时时返回转义后的纯文本，complete 为False，调用者不应缓存这样的页面"""
+    digest = content_digest(blog.content)
+    html = await html_cache.get(blog.id, digest)
+    if html is None:
+        def late(result):
+            asyncio.ensure_future(html_cache.set(blog.id, digest, result))
+
+        try:
+            html = await renderer.convert(blog.content, callback=late)
+        except asyncio.TimeoutError:
+            logging.warning('render blog %s timeout, fallback to plain text.' % blog.id)
+            return text2html(blog.content), False
+        await html_cache.set(blog.id, digest, html)
+    return html, True
+
+
+async def invalidate_blog(blog_id):
+    """日志修改或删除后丢弃对应的缓存"""
+    await html_cache.invalidate(blog_id)
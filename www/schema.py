@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+DDL generator and index advisor driven by the Model mappings.
+
+建表语句由 ModelMetaclass 收集的 __mappings__ 和模型上声明的 __indexes__、__unique_indexes__ 生成，
+test/schema.sql 与模型定义不再需要手工同步：
+
+    $ python3 schema.py > ../test/schema-models.sql
+
+advise() 对 orm.profiler 记录的每种SELECT执行 EXPLAIN，报告全表扫描、没有用到索引和需要额外排序的查询，
+并根据 where/order by 中的列给出建议的索引。
+"""
+
+import re, logging
+
+import orm
+
+from orm import Model
+
+_RE_TABLE = re.compile(r'\bfrom\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WHERE = re.compile(r'\bwhere\s+(.*?)(?:\border\s+by\b|\blimit\b|$)', re.IGNORECASE | re.DOTALL)
+_RE_ORDER = re.compile(r'\border\s+by\s+(.*?)(?:\blimit\b|$)', re.IGNORECASE | re.DOTALL)
+_RE_EQ_COLUMN = re.compile(r'`?(\w+)`?\s*(=|in\b)', re.IGNORECASE)
+_RE_RANGE_COLUMN = re.compile(r'`?(\w+)`?\s*(<=|>=|<|>|between\b|like\b)', re.IGNORECASE)
+_RE_COLUMN = re.compile(r'`?(\w+)`?')
+
+
+def index_name(columns):
+    return 'idx_%s' % '_'.join(columns)
+
+
+def create_table_sql(model):
+    """根据模型的字段映射生成 create table 语句，与 test/schema.sql 的格式一致"""
+    L = []
+    for name in [model.__primary_key__] + model.__fields__:
+        L.append('`%s` %s not null' % (name, model.__mappings__[name].column_type))
+    for columns in model.__unique_indexes__:
+        L.append('unique key `%s` (%s)' % (index_name(columns), ', '.join('`%s`' % c for c in columns)))
+    for columns in model.__indexes__:
+        L.append('key `%s` (%s)' % (index_name(columns), ', '.join('`%s`' % c for c in columns)))
+    L.append('primary key (`%s`)' % model.__primary_key__)
+    return 'create table %s (\n\t    %s\n) engine=innodb default charset=utf8;' % (
+        model.__table__, ',\n\t    '.join(L))
+
+
+def create_index_sql(model, columns, unique=False):
+    """生成单个索引的DDL，用于给已有的表补建索引"""
+    return 'alter table `%s` add %skey `%s` (%s);' % (
+        model.__table__, 'unique ' if unique else '', index_name(columns), ', '.join('`%s`' % c for c in columns))
+
+
+def all_models(module=None):
+    """返回模块中定义的所有模型，默认为 models 模块"""
+    if module is None:
+        import models as module
+    return [v for v in vars(module).values()
+            if isinstance(v, type) and issubclass(v, Model) and v is not Model and hasattr(v, '__table__')]
+
+
+def _covers(indexes, columns):
+    """已有索引的最左前缀能否覆盖 columns"""
+    n = len(columns)
+    return any(tuple(index[:n]) == tuple(columns) for index in indexes)
+
+
+def suggest_index(model, sql):
+    """按“等值条件列 + 排序列（或一个范围条件列）”的顺序建议索引，已有索引可以覆盖时返回None"""
+    mapped = set([model.__primary_key__] + model.__fields__)
+    columns = []
+    m = _RE_WHERE.search(sql)
+    where = m.group(1) if m else ''
+    for c, _ in _RE_EQ_COLUMN.findall(where):
+        if c in mapped and c not in columns:
+            columns.append(c)
+    m = _RE_ORDER.search(sql)
+    order = [c for c in _RE_COLUMN.findall(m.group(1)) if c in mapped] if m else []
+    if order:
+        columns.extend(c for c in order if c not in columns)
+    else:
+        columns.extend(c for c, _ in _RE_RANGE_COLUMN.findall(where)[:1] if c in mapped and c not in columns)
+    if not columns or columns == [model.__primary_key__]:
+        return None
+    indexes = [(model.__primary_key__,)] + model.__unique_indexes__ + model.__indexes__
+    if _covers(indexes, columns):
+        return None
+    return tuple(columns)
+
+
+def _problems(plan):
+    L = []
+    for row in plan:
+        extra = row.get('Extra') or ''
+        if row.get('type') == 'ALL':
+            L.append('full table scan on %s' % row.get('table'))
+        elif row.get('key') is None and row.get('table') is not None:
+            L.append('no index used on %s' % row.get('table'))
+        if 'Using filesort' in extra:
+            L.append('filesort on %s' % row.get('table'))
+        if 'Using temporary' in extra:
+            L.append('temporary table on %s' % row.get('table'))
+    return L
+
+
+async def advise(models=None):
+    """对记录过的每种SELECT执行EXPLAIN，返回有问题的查询及建议的索引DDL，按累计耗时从高到低排列"""
+    tables = dict((m.__table__, m) for m in (models or all_models()))
+    advice = []
+    samples = orm.profiler.samples()
+    for shape, h in orm.profiler.histograms().items():
+        if not shape.lower().startswith('select') or shape not in samples:
+            continue
+        sql, args = samples[shape]
+        m = _RE_TABLE.search(sql)
+        model = tables.get(m.group(1)) if m else None
+        if model is None:
+            continue
+        try:
+            plan = await orm.select('explain %s' % sql, args, primary=True)
+        except Exception as e:
+            logging.warning('explain failed: %s, %s' % (sql, e))
+            continue
+        problems = _problems(plan)
+        if not problems:
+            continue
+        columns = suggest_index(model, sql)
+        advice.append(dict(sql=shape, count=h.count, seconds=h.sum, problems=problems, plan=plan,
+                           index=None if columns is None else create_index_sql(model, columns)))
+    advice.sort(key=lambda a: a['seconds'], reverse=True)
+    return advice
+
+
+if __name__ == '__main__':
+    for m in all_models():
+        print(create_table_sql(m))
+        print()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+Signed-session cache for cookie2user.
+
+每个带cookie的请求都要 User.find() 并校验sha1，这里按cookie的摘要缓存校验通过的用户，
+进程内为有过期时间的LRU，可选地再加一层共享存储（接口与Redis的同名命令一致，LocalBackend 为进程内的替身）。
+用户修改口令或管理员标志后调用 invalidate_user()：本进程和共享存储立即失效，
+其他进程的进程内缓存最多在 ttl 秒后失效。
+"""
+
+import json, logging, hashlib, time
+
+from collections import OrderedDict
+
+
+class LocalBackend(object):
+    """进程内的共享存储替身，只实现 SessionCache 用到的 get/set/delete/incr"""
+
+    def __init__(self):
+        self._data = dict()  # key -> (value, expires_at)
+
+    def _alive(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            del self._data[key]
+            return None
+        return entry
+
+    async def get(self, key):
+        entry = self._alive(key)
+        return None if entry is None else entry[0]
+
+    async def set(self, key, value, ex=None):
+        self._data[key] = (value, None if ex is None else time.time() + ex)
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    async def incr(self, key):
+        entry = self._alive(key)
+        value = (0 if entry is None else int(entry[0])) + 1
+        self._data[key] = (str(value), None if entry is None else entry[1])
+        return value
+
+
+def cookie_digest(cookie_str):
+    return hashlib.sha1(cookie_str.encode('utf-8')).hexdigest()
+
+
+class SessionCache(object):
+    """cookie摘要 -> 用户数据(dict)，条目在 ttl 秒或cookie过期时失效，超出 maxsize 时淘汰最久未使用的条目"""
+
+    def __init__(self, ttl=300, maxsize=10000, backend=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # digest -> (user, uid, expires_at)
+        self._users = dict()  # uid -> set(digest)，用于按用户失效
+
+    def _drop(self, digest):
+        entry = self._data.pop(digest, None)
+        if entry is not None:
+            digests = self._users.get(entry[1])
+            if digests is not None:
+                digests.discard(digest)
+                if not digests:
+                    del self._users[entry[1]]
+
+    def _put(self, digest, user, uid, expires_at):
+        self._drop(digest)
+        self._data[digest] = (user, uid, expires_at)
+        self._users.setdefault(uid, set()).add(digest)
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+
+    async def get(self, cookie_str):
+        """返回缓存的用户数据，未命中返回None"""
+        if self.ttl <= 0:
+            return None
+        digest = cookie_digest(cookie_str)
+        entry = self._data.get(digest)
+        if entry is not None:
+            if entry[2] >= time.time():
+                self._data.move_to_end(digest)
+                self.hits += 1
+                return dict(entry[0])
+            self._drop(digest)
+        if self.backend is not None:
+            s = await self.backend.get('session:%s' % digest)
+            if s is not None:
+                data = json.loads(s)
+                gen = await self.backend.get('session-gen:%s' % data['uid'])
+                if data['gen'] == (gen or '0') and data['expires_at'] >= time.time():
+                    self._put(digest, data['user'], data['uid'], data['expires_at'])
+                    self.hits += 1
+                    return dict(data['user'])
+        self.misses += 1
+        return None
+
+    async def set(self, cookie_str, uid, expires, user):
+        """缓存校验通过的用户数据，expires为cookie的过期时间"""
+        if self.ttl <= 0:
+            return
+        digest = cookie_digest(cookie_str)
+        ttl = min(self.ttl, int(expires) - time.time())
+        if ttl <= 0:
+            return
+        expires_at = time.time() + ttl
+        user = dict(user)
+        self._put(digest, user, uid, expires_at)
+        if self.backend is not None:
+            gen = await self.backend.get('session-gen:%s' % uid)
+            s = json.dumps(dict(user=user, uid=uid, expires_at=expires_at, gen=gen or '0'), ensure_ascii=False)
+            await self.backend.set('session:%s' % digest, s, ex=int(ttl) + 1)
+
+    async def delete(self, cookie_str):
+        digest = cookie_digest(cookie_str)
+        self._drop(digest)
+        if self.backend is not None:
+            await self.backend.delete('session:%s' % digest)
+
+    async def invalidate_user(self, uid):
+        """用户口令或权限变化后，丢弃该用户所有已缓存的会话"""
+        for digest in list(self._users.get(uid, ())):
+            self._drop(digest)
+        if self.backend is not None:
+            await self.backend.incr('session-gen:%s' % uid)  # 共享存储中旧的会话数据因代数不匹配而失效
+
+
+session_cache = SessionCache()
+
+
+def init_session_cache(cache_ttl=300, cache_size=10000, cache_backend=None, **kw):
+    """按配置创建会话缓存，cache_backend 可以为 None、'local' 或实现了 get/set/delete/incr 的对象"""
+    global session_cache
+    backend = LocalBackend() if cache_backend == 'local' else cache_backend
+    session_cache = SessionCache(cache_ttl, cache_size, backend)
+    logging.info('session cache: ttl=%ss, size=%s, backend=%s' % (cache_ttl, cache_size, cache_backend))
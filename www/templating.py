@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'XueSong.Ye'
+
+"""
+Production helpers for the Jinja2 environment built by app.init_jinja2().
+
+默认配置下每次 get_template() 都要检查模板文件是否修改，每个进程冷启动时都要重新编译所有模板。生产环境中：
+
+* auto_reload=False，启动时一次性解析所有模板，response_factory 直接使用解析好的 Template 对象；
+* bytecode_cache 为 'memory' 或目录路径，目录可以在多个进程间共享编译结果；
+* compiled 为目录路径时，启动时把模板预编译为Python模块（模板有修改时重新编译），之后从模块直接加载。
+"""
+
+import os, logging, shutil
+
+from jinja2 import BytecodeCache, FileSystemBytecodeCache
+
+
+class MemoryBytecodeCache(BytecodeCache):
+    """进程内的字节码缓存：bucket key -> 字节码"""
+
+    def __init__(self):
+        self._data = dict()
+
+    def load_bytecode(self, bucket):
+        code = self._data.get(bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        self._data[bucket.key] = bucket.bytecode_to_string()
+
+    def clear(self):
+        self._data.clear()
+
+
+def make_bytecode_cache(spec):
+    """spec 为 None、'memory' 或缓存目录"""
+    if spec is None:
+        return None
+    if spec == 'memory':
+        return MemoryBytecodeCache()
+    os.makedirs(spec, exist_ok=True)
+    return FileSystemBytecodeCache(spec)
+
+
+def _newest(path):
+    newest = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            newest = max(newest, os.path.getmtime(os.path.join(root, f)))
+    return newest
+
+
+def compile_templates(env, source, target):
+    """模板目录 source 有比 target 新的文件时，把所有模板重新编译为Python模块写入 target。
+
+    先编译到临时目录再改名，多个进程同时启动时不会读到写了一半的模块。
+    """
+    if os.path.isdir(target) and _newest(target) >= _newest(source):
+        return False
+    tmp = '%s.%s.tmp' % (target.rstrip(os.sep), os.getpid())
+    env.compile_templates(tmp, zip=None, ignore_errors=False)
+    shutil.rmtree(target, ignore_errors=True)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # 其他进程已经先完成了编译
+    logging.info('compiled templates %s => %s' % (source, target))
+    return True
+
+
+def preload(env, names):
+    """启动时解析所有模板，返回 name -> Template"""
+    templates = dict((name, env.get_template(name)) for name in names)
+    logging.info('preloaded %s templates' % len(templates))
+    return templates